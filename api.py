@@ -1,14 +1,26 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Header, Response
 from pydantic import BaseModel, Field
-from test import app_graph
+from test import NO_ANSWER, app_graph
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from cachetools import TTLCache
+import orjson
+import asyncio
+import hashlib
 import logging
-from typing import List, Dict, Any
+import re
+from typing import AsyncIterator, List, Dict, Any, Optional, Tuple
 
 # ======================================================
 # FastAPI Initialization
 # ======================================================
+class FastJSONResponse(ORJSONResponse):
+    """ORJSONResponse that stringifies values orjson can't encode (e.g. BLOB bytes)."""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=str, option=orjson.OPT_NON_STR_KEYS)
+
 app = FastAPI(
     title="SQL Chart Visualization API",
     version="1.2.0",
@@ -22,6 +34,7 @@ app = FastAPI(
     """,
     docs_url="/docs",   # Swagger UI
     redoc_url=None,     # Disable default Redoc (custom version below)
+    default_response_class=FastJSONResponse,
 )
 
 # ======================================================
@@ -49,6 +62,59 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ======================================================
+# Compression (large /ask JSON results)
+# ======================================================
+# SSE endpoints must not be compressed: the compressor would hold events back
+_UNCOMPRESSED_PATHS = ("/ask/stream",)
+
+class StreamSafeGZipMiddleware(GZipMiddleware):
+    """GZipMiddleware that passes _UNCOMPRESSED_PATHS through untouched."""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in _UNCOMPRESSED_PATHS:
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+try:
+    from brotli_asgi import BrotliMiddleware  # falls back to gzip for older clients
+    app.add_middleware(
+        BrotliMiddleware,
+        quality=4,
+        minimum_size=1024,
+        excluded_handlers=[f"^{path}$" for path in _UNCOMPRESSED_PATHS],
+    )
+except ImportError:
+    app.add_middleware(StreamSafeGZipMiddleware, minimum_size=1024, compresslevel=5)
+
+# ======================================================
+# Response Cache + Single-Flight
+# ======================================================
+# Repeat queries (e.g. dashboard polling) are answered from memory
+_CACHE: TTLCache = TTLCache(maxsize=512, ttl=300)
+
+# Queries whose answer depends on the current time are never cached
+_RE_TIME_RELATIVE = re.compile(
+    r"\b(today|now|yesterday|tomorrow|current|currently|latest|recent|this (week|month|year))\b",
+    re.IGNORECASE,
+)
+
+def cache_key(query: str) -> str:
+    """Normalize a query for cache lookups (trimmed, lower-cased, single-spaced)."""
+    return " ".join(query.split()).lower()
+
+def is_cacheable(query: str) -> bool:
+    return not _RE_TIME_RELATIVE.search(query)
+
+# In-flight pipeline runs keyed by cache_key(query)
+_INFLIGHT: Dict[str, "asyncio.Task[Tuple[Dict[str, Any], bool]]"] = {}
+
+def release_inflight(key: str, task: "asyncio.Task") -> None:
+    """Drop a finished run from _INFLIGHT (unless a newer one replaced it)."""
+    if _INFLIGHT.get(key) is task:
+        del _INFLIGHT[key]
+
 # ======================================================
 # Models
 # ======================================================
@@ -72,10 +138,40 @@ class ErrorResponse(BaseModel):
 # ======================================================
 # Endpoints
 # ======================================================
+async def run_pipeline(query: str) -> Tuple[Dict[str, Any], bool]:
+    """Run the LangGraph pipeline and shape its final state into a response.
+
+    Returns (response, succeeded); a run whose SQL or chart/answer LLM call
+    failed is not a success.
+    """
+    final_state = await app_graph.ainvoke({"query": query})
+
+    sql = final_state.get("sql", "")
+    result = final_state.get("result", [])
+    answer = final_state.get("answer", NO_ANSWER)
+
+    # ✅ Ensure result is always a list of dicts
+    if not isinstance(result, list):
+        logger.warning("⚠️ Invalid result format, coercing to empty list")
+        result = []
+
+    logger.info(f"📝 Generated SQL: {sql}")
+    logger.info(f"📊 Rows returned: {len(result)}")
+
+    response = {
+        "answer": answer,
+        "chart_type": final_state.get("chart_type", "bar"),
+        "chart_config": final_state.get("chart_config", {}),
+        "sql": sql,
+        "result": result,
+    }
+    succeeded = not (final_state.get("sql_error") or final_state.get("llm_error"))
+    return response, succeeded
+
 @app.post(
     "/ask",
-    response_model=QueryResponse,
-    responses={500: {"model": ErrorResponse}},
+    # documented only: rows are returned as-is, not re-validated by Pydantic
+    responses={200: {"model": QueryResponse}, 500: {"model": ErrorResponse}},
     tags=["Query"]
 )
 async def ask(request: QueryRequest):
@@ -88,35 +184,78 @@ async def ask(request: QueryRequest):
     try:
         logger.info(f"📩 Received query: {request.query}")
 
-        final_state = app_graph.invoke({"query": request.query})
-
-        sql = final_state.get("sql", "")
-        result = final_state.get("result", [])
-        answer = final_state.get("answer", "No answer generated")
-
-        # ✅ Ensure result is always a list of dicts
-        if not isinstance(result, list):
-            logger.warning("⚠️ Invalid result format, coercing to empty list")
-            result = []
+        key = cache_key(request.query)
+        cacheable = is_cacheable(request.query)
+        # single lookup: TTLCache re-checks expiry on every access
+        cached = _CACHE.get(key) if cacheable else None
+        if cached is not None:
+            logger.info("⚡ Cache hit")
+            return FastJSONResponse(cached)
 
-        logger.info(f"📝 Generated SQL: {sql}")
-        logger.info(f"📊 Rows returned: {len(result)}")
+        # Single-flight: identical concurrent queries share one pipeline run
+        task = _INFLIGHT.get(key)
+        if task is None:
+            task = asyncio.ensure_future(run_pipeline(request.query))
+            _INFLIGHT[key] = task
+            task.add_done_callback(lambda t: release_inflight(key, t))
+        else:
+            logger.info("🔗 Joining in-flight request for the same query")
 
-        return {
-            "answer": answer,
-            "chart_type": final_state.get("chart_type", "bar"),
-            "chart_config": final_state.get("chart_config", {}),
-            "sql": sql,
-            "result": result,
-        }
+        # shield so one client disconnecting doesn't cancel the shared run
+        response, succeeded = await asyncio.shield(task)
+        # failed runs are not cached: a retry regenerates the SQL and may succeed
+        if cacheable and succeeded:
+            _CACHE[key] = response
+        return FastJSONResponse(response)
 
     except Exception as e:
         logger.error(f"❌ Error processing query: {e}", exc_info=True)
-        return JSONResponse(
+        return FastJSONResponse(
             status_code=500,
             content={"error": "Internal Server Error", "detail": str(e)},
         )
 
+# State keys each node contributes to the SSE stream
+_STREAM_KEYS = {
+    "generate_sql": ("sql",),
+    "execute_sql": ("result",),
+    "generate_chart_and_answer": ("chart_type", "chart_config", "answer"),
+    "add_forecast_with_arima": ("chart_config",),
+}
+
+def sse_event(event: str, data: Any) -> bytes:
+    """Encode one Server-Sent Event."""
+    payload = orjson.dumps(data, default=str, option=orjson.OPT_NON_STR_KEYS)
+    return b"event: " + event.encode() + b"\ndata: " + payload + b"\n\n"
+
+async def stream_pipeline(query: str) -> AsyncIterator[bytes]:
+    """Yield each node's output as soon as it finishes, then a final `done` event."""
+    try:
+        async for update in app_graph.astream({"query": query}, stream_mode="updates"):
+            for node, node_state in update.items():
+                node_state = node_state or {}
+                keys = _STREAM_KEYS.get(node, ())
+                yield sse_event(node, {k: node_state[k] for k in keys if k in node_state})
+        yield sse_event("done", {})
+
+    except Exception as e:
+        logger.error(f"❌ Error streaming query: {e}", exc_info=True)
+        yield sse_event("error", {"error": "Internal Server Error", "detail": str(e)})
+
+@app.post("/ask/stream", tags=["Query"])
+async def ask_stream(request: QueryRequest):
+    """
+    Same pipeline as `/ask`, streamed as Server-Sent Events:
+    one event per graph node (`generate_sql`, `execute_sql`,
+    `generate_chart_and_answer`, `add_forecast_with_arima`), then `done`.
+    """
+    logger.info(f"📩 Received streaming query: {request.query}")
+    return StreamingResponse(
+        stream_pipeline(request.query),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
 @app.get("/health", tags=["System"])
 async def health_check():
     """Simple health check."""
@@ -125,10 +264,7 @@ async def health_check():
 # ======================================================
 # Custom Redoc (with Dark Mode Toggle)
 # ======================================================
-@app.get("/redoc", include_in_schema=False)
-async def custom_redoc():
-    """Custom ReDoc UI with Dark Mode toggle + branding."""
-    html_content = """
+_REDOC_HTML = """
     <!DOCTYPE html>
     <html>
     <head>
@@ -195,4 +331,13 @@ async def custom_redoc():
     </body>
     </html>
     """
-    return HTMLResponse(content=html_content)
\ No newline at end of file
+_REDOC_BYTES = _REDOC_HTML.encode("utf-8")
+_REDOC_ETAG = f'"{hashlib.md5(_REDOC_BYTES).hexdigest()}"'
+_REDOC_HEADERS = {"Cache-Control": "public, max-age=86400", "ETag": _REDOC_ETAG}
+
+@app.get("/redoc", include_in_schema=False)
+async def custom_redoc(if_none_match: Optional[str] = Header(None)):
+    """Custom ReDoc UI with Dark Mode toggle + branding."""
+    if if_none_match and _REDOC_ETAG in if_none_match:
+        return Response(status_code=304, headers=_REDOC_HEADERS)
+    return Response(content=_REDOC_BYTES, media_type="text/html", headers=_REDOC_HEADERS)
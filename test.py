@@ -1,16 +1,28 @@
 import re
 import json
 import os
+import asyncio
 import logging
 import sqlite3
 import random
+import queue
+from itertools import repeat
 from typing import TypedDict, Any, Dict, List
 
+import orjson
 from dotenv import load_dotenv
 from langchain_community.utilities import SQLDatabase
 from langgraph.graph import StateGraph, END
 from langchain_groq import ChatGroq
 
+# Forecasting is optional: load it once at import if available
+try:
+    import pandas as pd
+    from statsmodels.tsa.arima.model import ARIMA
+except ImportError:
+    pd = None
+    ARIMA = None
+
 # ============================================================
 # Setup
 # ============================================================
@@ -25,12 +37,56 @@ db = SQLDatabase.from_uri(
     sample_rows_in_table_info=0
 )
 
+# Small pool of read-only SQLite connections for execute_sql: each keeps its
+# page cache across requests, and queries from different requests run in parallel
+_POOL_SIZE = 4
+
+# Generated SQL may not attach other databases or change connection settings
+_DENIED_ACTIONS = {sqlite3.SQLITE_ATTACH, sqlite3.SQLITE_DETACH, sqlite3.SQLITE_PRAGMA}
+
+
+def _authorize(action, *args):
+    return sqlite3.SQLITE_DENY if action in _DENIED_ACTIONS else sqlite3.SQLITE_OK
+
+
+def _open_readonly_conn() -> sqlite3.Connection:
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+    for pragma in (
+        "PRAGMA query_only=ON",  # also rejects TEMP tables, which mode=ro allows
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-16000",  # ~16 MB per connection
+    ):
+        conn.execute(pragma)
+    conn.set_authorizer(_authorize)
+    return conn
+
+
+_CONN_POOL: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+for _ in range(_POOL_SIZE):
+    _CONN_POOL.put(_open_readonly_conn())
+
+# Patterns used to clean up LLM output
+_RE_SQL_FENCE_OPEN = re.compile(r"^```sql", re.IGNORECASE)
+_RE_SQL_FENCE_CLOSE = re.compile(r"```$")
+
+# Schema is fixed, so read the table info once instead of per request
+_SCHEMA_INFO = db.get_table_info()
+
 # LLM setup
 llm = ChatGroq(
     model="gemma2-9b-it",
     api_key=os.getenv("GROQ_API_KEY")
 )
 
+# Chart config + answer use Groq JSON mode: the response is always a valid JSON object
+chart_llm = llm.bind(response_format={"type": "json_object"})
+
+# Fallback answer when the model doesn't provide one (shared with api.py)
+NO_ANSWER = "No answer generated"
+
+# How long a node's batcher waits to coalesce concurrent prompts
+BATCH_WINDOW_MS = 20
+
 # ============================================================
 # State Structure
 # ============================================================
@@ -41,25 +97,143 @@ class ChatState(TypedDict):
     answer: str
     chart_type: str
     chart_config: Dict
+    sql_error: str
+    llm_error: str
 
 # ============================================================
 # Utility
 # ============================================================
-def random_color(alpha: float = 0.7) -> str:
-    """Generate random RGBA color string."""
-    return f"rgba({random.randint(0,255)}, {random.randint(0,255)}, {random.randint(0,255)}, {alpha})"
+# Random palette built once at import; charts cycle through it
+_PALETTE_SIZE = 256
+_PALETTE_RGB = [
+    (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
+    for _ in range(_PALETTE_SIZE)
+]
+
+
+def _palette(alpha: float) -> List[str]:
+    return [f"rgba({r}, {g}, {b}, {alpha})" for r, g, b in _PALETTE_RGB]
+
+
+_PALETTE = _palette(0.7)
+_PALETTE_LINE_BORDER = _palette(1.0)
+_PALETTE_LINE_FILL = _palette(0.2)
+
+
+def palette_colors(n: int, offset: int = 0) -> List[str]:
+    """n colors from the precomputed palette starting at offset, cycling."""
+    offset %= _PALETTE_SIZE
+    rotated = _PALETTE[offset:] + _PALETTE[:offset]
+    full, rest = divmod(n, _PALETTE_SIZE)
+    return rotated * full + rotated[:rest]
+
+
+def summarize_for_prompt(result: Any, k: int = 50) -> str:
+    """Compact JSON view of a result for prompts: columns, row count, first k rows."""
+    rows = result if isinstance(result, list) else []
+    summary = {
+        "columns": list(rows[0]) if rows else [],
+        "row_count": len(rows),
+        "sample": rows[:k],
+    }
+    return orjson.dumps(summary, default=str).decode()
+
+
+def log_cache_usage(node: str, response) -> None:
+    """Log Groq prompt-cache hit rate (cached_tokens / prompt_tokens)."""
+    metadata = getattr(response, "response_metadata", None) or {}
+    usage = (metadata.get("x_groq") or {}).get("usage") or metadata.get("token_usage") or {}
+    prompt_tokens = usage.get("prompt_tokens") or 0
+    cached_tokens = usage.get("cached_tokens")
+    if cached_tokens is None:
+        cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+
+    if prompt_tokens:
+        logger.info(
+            f"🗄️ [{node}] prompt cache: {cached_tokens}/{prompt_tokens} tokens "
+            f"({cached_tokens / prompt_tokens:.0%} hit)"
+        )
+
+# ============================================================
+# LLM Micro-Batching
+# ============================================================
+class LLMBatcher:
+    """Coalesce concurrent prompts for one node into dispatch rounds.
+
+    Each call enqueues its prompt with a future. When no call is in flight the
+    prompt is sent at once; while calls are in flight, the worker waits up to
+    BATCH_WINDOW_MS to gather followers into one round. Every prompt still
+    gets its own Groq request (there is no batch endpoint), and each future
+    resolves as soon as its own call returns, so this mainly bounds dispatch
+    bursts; it is latency-neutral at best, never a reduction in calls.
+    """
+
+    def __init__(self, model, window_ms: int = BATCH_WINDOW_MS):
+        self.model = model
+        self.window = window_ms / 1000
+        self._queue = None
+        self._worker = None
+        self._inflight = set()  # strong refs to running calls
+
+    async def ainvoke(self, prompt: str):
+        # queue + worker are bound to the running loop, so create them lazily
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((prompt, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+
+            # idle → send immediately; busy → coalesce followers for one window
+            if self._inflight:
+                deadline = loop.time() + self.window
+                while (remaining := deadline - loop.time()) > 0:
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                    except asyncio.TimeoutError:
+                        break
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            # dispatch without waiting, so prompts arriving meanwhile aren't held back
+            for prompt, future in batch:
+                task = asyncio.create_task(self._call(prompt, future))
+                self._inflight.add(task)
+                task.add_done_callback(self._inflight.discard)
+
+            if len(batch) > 1:
+                logger.info(f"📦 Dispatched {len(batch)} concurrent LLM calls together")
+
+    async def _call(self, prompt: str, future: asyncio.Future):
+        try:
+            response = await self.model.ainvoke(prompt)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(response)
+
+
+sql_batcher = LLMBatcher(llm)
+chart_answer_batcher = LLMBatcher(chart_llm)
 
 # ============================================================
 # Nodes
 # ============================================================
-def generate_sql(state: dict) -> dict:
+async def generate_sql(state: dict) -> dict:
     """Generate SQL query from natural language."""
-    schema = db.get_table_info()
     prompt = f"""
     You are an expert SQL assistant. Generate a valid SQLite query
     for the following schema:
 
-    {schema}
+    {_SCHEMA_INFO}
 
     Notes:
     - Use exact table names, **with quotes** if they contain spaces (like "Order Details").
@@ -69,30 +243,40 @@ def generate_sql(state: dict) -> dict:
     Question: {state["query"]}
     """
 
-    response = llm.invoke(prompt)
+    response = await sql_batcher.ainvoke(prompt)
+    log_cache_usage("generate_sql", response)
     sql = response.content.strip()
 
     # cleanup
-    sql = re.sub(r"^```sql", "", sql, flags=re.IGNORECASE).strip()
-    sql = re.sub(r"```$", "", sql).strip()
+    sql = _RE_SQL_FENCE_OPEN.sub("", sql).strip()
+    sql = _RE_SQL_FENCE_CLOSE.sub("", sql).strip()
 
     state["sql"] = sql
     logger.info(f"📝 Generated SQL: {sql}")
     return state
 
 
-def execute_sql(state: dict) -> dict:
-    """Run the generated SQL against the database."""
+def _run_query(sql: str) -> List[Dict[str, Any]]:
+    """Blocking SQLite roundtrip; called off the event loop."""
+    conn = _CONN_POOL.get()
     try:
-        conn = sqlite3.connect(db_path)
         cursor = conn.cursor()
-        cursor.execute(state["sql"])
-        rows = cursor.fetchall()
+        cursor.execute(sql)
         cols = [desc[0] for desc in cursor.description]
-        conn.close()
 
-        # convert tuples → dicts
-        result: List[Dict[str, Any]] = [dict(zip(cols, row)) for row in rows]
+        # stream tuples → dicts straight off the cursor (no fetchall copy)
+        result = list(map(dict, map(zip, repeat(cols), cursor)))
+        cursor.close()
+    finally:
+        _CONN_POOL.put(conn)
+
+    return result
+
+
+async def execute_sql(state: dict) -> dict:
+    """Run the generated SQL against the database."""
+    try:
+        result = await asyncio.to_thread(_run_query, state["sql"])
         state["result"] = result
         logger.info(f"✅ Query returned {len(result)} rows")
 
@@ -100,110 +284,114 @@ def execute_sql(state: dict) -> dict:
         logger.error(f"❌ SQL Execution Error: {e}")
         state["result"] = []
         state["answer"] = f"SQL Execution Error: {str(e)}"
+        state["sql_error"] = str(e)
 
     return state
 
 
-def generate_chart_config(state: dict) -> dict:
-    """Suggest best chart config for the result and add random colors."""
+async def generate_chart_and_answer(state: dict) -> dict:
+    """Suggest chart config and write the final answer in one LLM call, then add colors."""
+    # static instructions first, per-request data last (Groq caches by prefix)
     prompt = f"""
     You are a data visualization assistant.
-    Based on the SQL query result below, suggest the best chart type and config.
-
-    Question: {state["query"]}
-    SQL: {state["sql"]}
-    Result: {state["result"]}
+    The SQL query executed successfully. Based on the result below,
+    suggest the best chart type and config, and answer the user's question.
 
     Rules:
     - Choose chart_type from: ["bar", "line", "pie", "table"].
-    - Output JSON only with keys: chart_type, chart_config.
+    - Output JSON only with keys: chart_type, chart_config, answer.
     - chart_config must have "labels" and "datasets" compatible with Chart.js.
-    """
-
-    response = llm.invoke(prompt)
-    raw = response.content.strip()
+    - answer must be a clear, concise natural language answer based on the result.
 
-    # extract JSON safely
-    match = re.search(r"\{.*\}", raw, re.DOTALL)
-    if not match:
-        logger.error(f"⚠️ Invalid chart config response: {raw}")
-        state["chart_type"] = "table"
-        state["chart_config"] = {"labels": [], "datasets": []}
-        return state
+    Question: {state["query"]}
+    SQL: {state["sql"]}
+    Result sample: {summarize_for_prompt(state["result"])}
+    """
 
+    # A failed call (rate limit, timeout, 5xx, JSON validation) keeps the SQL
+    # rows but is flagged, so the degraded response is never cached
     try:
-        parsed = json.loads(match.group(0))
-        chart_type = parsed.get("chart_type", "table")
-        chart_config = parsed.get("chart_config", {"labels": [], "datasets": []})
-
-        labels = chart_config.get("labels", [])
-        datasets = chart_config.get("datasets", [])
+        response = await chart_answer_batcher.ainvoke(prompt)
+    except Exception as e:
+        logger.error(f"❌ Chart/answer LLM call failed: {e}")
+        return {
+            "chart_type": "table",
+            "chart_config": {"labels": [], "datasets": []},
+            "answer": NO_ANSWER,
+            "llm_error": str(e),
+        }
+    log_cache_usage("generate_chart_and_answer", response)
+
+    # Malformed content or shape falls back to a plain table
+    try:
+        parsed = orjson.loads(response.content)
+    except orjson.JSONDecodeError as e:
+        logger.error(f"⚠️ JSON Parse Error: {e}")
+        parsed = {}
+    if not isinstance(parsed, dict):
+        logger.error(f"⚠️ Expected a JSON object, got {type(parsed).__name__}")
+        parsed = {}
 
-        if datasets:
-            for ds in datasets:
-                if chart_type in ["bar", "pie"] and labels:
-                    ds["backgroundColor"] = [random_color() for _ in labels]
-                elif chart_type == "line":
-                    ds["borderColor"] = random_color(1.0)
-                    ds["backgroundColor"] = random_color(0.2)
+    chart_type = parsed.get("chart_type") or "table"
+    chart_config = parsed.get("chart_config")
+    if not isinstance(chart_config, dict):
+        chart_type = "table"
+        chart_config = {"labels": [], "datasets": []}
+    answer = str(parsed.get("answer") or "").strip() or NO_ANSWER
 
-            logger.info(f"🎨 Applied random colors for {chart_type} chart")
+    labels = chart_config.get("labels", [])
+    datasets = chart_config.get("datasets", [])
 
-        state["chart_type"] = chart_type
-        state["chart_config"] = chart_config
+    if isinstance(datasets, list) and datasets:
+        offset = random.randrange(_PALETTE_SIZE)
+        for i, ds in enumerate(datasets):
+            if not isinstance(ds, dict):
+                continue
+            if chart_type in ["bar", "pie"] and labels:
+                ds["backgroundColor"] = palette_colors(len(labels), offset + i)
+            elif chart_type == "line":
+                idx = (offset + i) % _PALETTE_SIZE
+                ds["borderColor"] = _PALETTE_LINE_BORDER[idx]
+                ds["backgroundColor"] = _PALETTE_LINE_FILL[idx]
 
-    except json.JSONDecodeError as e:
-        logger.error(f"⚠️ JSON Parse Error: {e}")
-        state["chart_type"] = "table"
-        state["chart_config"] = {"labels": [], "datasets": []}
+        logger.info(f"🎨 Applied random colors for {chart_type} chart")
 
-    return state
+    return {"chart_type": chart_type, "chart_config": chart_config, "answer": answer}
 
 
-def generate_answer(state: dict) -> dict:
-    """Generate final natural language answer."""
-    prompt = f"""
-    The SQL query executed successfully.
+def _fit_forecast(result: List[Dict[str, Any]]):
+    """Fit ARIMA on period/value rows (CPU-bound); returns None if unusable."""
+    df = pd.DataFrame(result)
+    df["period"] = pd.to_datetime(df["period"], errors="coerce")
+    df = df.dropna()
 
-    Question: {state["query"]}
-    SQL: {state["sql"]}
-    Result: {state["result"]}
+    if df.empty:
+        return None
 
-    Please provide a clear, concise answer to the user based on the result.
-    """
-    response = llm.invoke(prompt)
-    state["answer"] = response.content.strip()
-    return state
+    model = ARIMA(df["value"], order=(2, 1, 2))
+    fitted = model.fit()
+    return fitted.forecast(steps=6).tolist()  # predict 6 future periods
 
 
-def add_forecast_with_arima(state: dict) -> dict:
+async def add_forecast_with_arima(state: dict) -> dict:
     """(Optional) Add ARIMA forecast for time series queries."""
-    try:
-        import pandas as pd
-        from statsmodels.tsa.arima.model import ARIMA
-
-        result = state.get("result", [])
-        if not result or not isinstance(result, list):
-            return state
-
-        # Must contain both "period" and "value"
-        if not all(key in result[0] for key in ["period", "value"]):
-            return state
+    # Cheap schema check first: most results are not period/value series
+    result = state.get("result")
+    if not result or not isinstance(result, list) or not {"period", "value"}.issubset(result[0]):
+        return state
 
-        df = pd.DataFrame(result)
-        df["period"] = pd.to_datetime(df["period"], errors="coerce")
-        df = df.dropna()
+    if ARIMA is None:
+        logger.warning("⚠️ ARIMA forecast skipped: pandas/statsmodels not installed")
+        return state
 
-        if df.empty:
+    try:
+        forecast = await asyncio.to_thread(_fit_forecast, result)
+        if forecast is None:
             return state
 
-        model = ARIMA(df["value"], order=(2, 1, 2))
-        fitted = model.fit()
-        forecast = fitted.forecast(steps=6)  # predict 6 future periods
-
         state["chart_config"].setdefault("datasets", []).append({
             "label": "Forecast",
-            "data": forecast.tolist(),
+            "data": forecast,
             "borderColor": "rgba(255,0,0,1)",
             "backgroundColor": "rgba(255,0,0,0.3)"
         })
@@ -221,16 +409,14 @@ graph = StateGraph(ChatState)
 
 graph.add_node("generate_sql", generate_sql)
 graph.add_node("execute_sql", execute_sql)
-graph.add_node("generate_chart_config", generate_chart_config)
-graph.add_node("generate_answer", generate_answer)
+graph.add_node("generate_chart_and_answer", generate_chart_and_answer)
 graph.add_node("add_forecast_with_arima", add_forecast_with_arima)
 
 graph.set_entry_point("generate_sql")
 graph.add_edge("generate_sql", "execute_sql")
-graph.add_edge("execute_sql", "generate_chart_config")
-graph.add_edge("generate_chart_config", "add_forecast_with_arima")
-graph.add_edge("add_forecast_with_arima", "generate_answer")
-graph.add_edge("generate_answer", END)
+graph.add_edge("execute_sql", "generate_chart_and_answer")
+graph.add_edge("generate_chart_and_answer", "add_forecast_with_arima")
+graph.add_edge("add_forecast_with_arima", END)
 
 app_graph = graph.compile()
 
@@ -239,5 +425,5 @@ app_graph = graph.compile()
 # ============================================================
 if __name__ == "__main__":
     user_input = {"query": "Show me total sales per category"}
-    final_state = app_graph.invoke(user_input)
+    final_state = asyncio.run(app_graph.ainvoke(user_input))
     print(json.dumps(final_state, indent=2))
\ No newline at end of file